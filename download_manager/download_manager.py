@@ -1,8 +1,13 @@
-from concurrent.futures import ThreadPoolExecutor
-from urllib.request import urlretrieve, urlopen
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from urllib.error import HTTPError, URLError
 from pathlib import Path
-import os, itertools, time, urllib, logging, base64
+import os, time, urllib, logging, base64, sqlite3, shutil, random, threading
 from http.cookiejar import CookieJar
+from collections import defaultdict, deque
+from datetime import datetime
+from functools import lru_cache
+import urllib3
 from abc import abstractmethod
 from .file_metadata import FileMetadata
 import pandas as pd
@@ -14,6 +19,25 @@ from nimbus.common.exception import MaximumTrialExceededError, IncompleteDownloa
 # from nimbus.common.file_metadata import FileMetadata
 import nimbus.common.sql as sql
 
+# Upper bound on the number of download threads. More threads is not always faster even for I/O bound work,
+# and NOAA S3 throughput stops improving well before this.
+MAX_WORKERS = 32
+
+# Files are downloaded as byte ranges of _MULTIPART_PART_SIZE, up to _MULTIPART_N_PARTS at a time (see download_file_multipart()).
+_MULTIPART_PART_SIZE = 64 * 1024 * 1024
+_MULTIPART_N_PARTS = 4
+
+# Connection pool shared by all downloads so that TCP+TLS connections are reused across files (and threads).
+# maxsize allows every worker to download in _MULTIPART_N_PARTS parts at once, so that workers never contend for connections.
+# Retries are handled by safe_download_file(); urllib3 only follows redirects.
+# timeout makes a stalled connection raise (and be retried) rather than block a worker forever.
+# read is the maximum wait between two reads from the socket, not for the whole file.
+_POOL = urllib3.PoolManager(
+    maxsize=MAX_WORKERS * _MULTIPART_N_PARTS, block=False,
+    retries=urllib3.Retry(total=None, connect=0, read=0, other=0, redirect=5),
+    timeout=urllib3.Timeout(connect=10.0, read=60.0)
+)
+
 class DownloadManager():
     """Parent class ob an onject, designed to take care of a large number of large files.
     Some of the features includes:
@@ -30,7 +54,9 @@ class DownloadManager():
                  base_dir: str,
                  log_filename: str,
                  db_field_dtypes: dict,#sql compatible
-                 buffer_dir: str=None
+                 buffer_dir: str=None,
+                 max_workers: int=None,
+                 sqlite_wal: bool=False
         ):
         if not os.path.exists(base_dir):
             # prevent accidentally creating whole new storage by typo
@@ -50,6 +76,17 @@ class DownloadManager():
         self.data_dir  = f"{base_dir}/data/"
         self.buffer_dir = buffer_dir
 
+        # number of parallel downloads. Defaults to the same heuristic as ThreadPoolExecutor for I/O bound work, capped at MAX_WORKERS.
+        if max_workers is None:
+            max_workers = min(MAX_WORKERS, (os.cpu_count() or 1) * 5)
+        if not 0 < max_workers <= MAX_WORKERS:
+            raise ValueError(f"Expected 0 < max_workers <= {MAX_WORKERS}. Got {max_workers=} instead.")
+        self.max_workers = max_workers
+
+        # WAL lets readers and the writer work concurrently, but SQLite does not support it on network filesystems (e.g. Lustre)
+        # or when the database is accessed from more than one host. Only enable it for databases on local disk.
+        self.sqlite_wal = sqlite_wal
+
 
     """####################################################"""
     """ --- Functions to be implemented by subclasses. --- """
@@ -103,64 +140,94 @@ class DownloadManager():
             if end is None: raise ValueError("If mode='range', arg 'end' must be specified")
             source_filenames, buffer_filenames, local_filenames, database_filenames = self.calculate_filenames_for_range(start=start, end=end, **kwargs)
 
-        # initialize database. mode='latest' or 'range' could result in multiple databases to be initialized, as database is monthly
-        logging.info("Checking database for already existing files.")
-        for db_filename in set(database_filenames):
-            sql.init_database(db_filename=db_filename, table='file', column_dtype=self.db_field_dtypes, primary_key='source_filename')
+        # connections of this call only. Other calls (e.g., another manager in another thread) have their own.
+        conns = _ConnectionCache()
+        try:
+            # initialize database. mode='latest' or 'range' could result in multiple databases to be initialized, as database is monthly
+            logging.info("Checking database for already existing files.")
+            for db_filename in set(database_filenames):
+                sql.init_database(db_filename=db_filename, table='file', column_dtype=self.db_field_dtypes, primary_key='source_filename')
+                if self.sqlite_wal:
+                    _enable_wal(db_filename, conns)
         
-        # filter down to only files we do not have in database (dne = Does Not Exist)
-        dne = [not sql.exists(db_filename=d_filename, table='file', attr='source_filename', val=s_filename)\
-                for (d_filename, s_filename) in zip(database_filenames, source_filenames)]
-        source_filenames = list(itertools.compress(source_filenames, dne))
-        buffer_filenames = list(itertools.compress(buffer_filenames, dne))
-        local_filenames = list(itertools.compress(local_filenames, dne))
-        database_filenames = list(itertools.compress(database_filenames, dne))
-
-        logging.info(f"Found {len(source_filenames)} new files.")
-        if sum(dne) == 0:
-            logging.info(f"Completed downloading.")
-            return
-
-        if not sequential:
-            # use ThreadPoolExecutor to delay rising Errors until all workers have completed their jobs.
-            with ThreadPoolExecutor(max_workers=10) as exe:
-                futures = [exe.submit(
-                        download_process_insert,
-                        dict(
-                            source_filename=source_filename, buffer_filename=buffer_filename, local_filename=local_filename, database_filename=database_filename,
-                            credentials=credentials, callback=self.callback
-                        )
+            # filter down to only files we do not have in database (dne = Does Not Exist)
+            # query each database once in batches instead of once per file.
+            source_filenames_per_db = defaultdict(list)
+            for (d_filename, s_filename) in zip(database_filenames, source_filenames):
+                source_filenames_per_db[d_filename].append(s_filename)
+            existing = set()
+            for d_filename, s_filenames in source_filenames_per_db.items():
+                existing |= lookup_existing_batch(d_filename, s_filenames, conns)
+            # (source_filename, buffer_filename, local_filename, database_filename) of files to download.
+            new_files = [filenames for filenames in zip(source_filenames, buffer_filenames, local_filenames, database_filenames) if filenames[0] not in existing]
+
+            logging.info(f"Found {len(new_files)} new files.")
+            if len(new_files) == 0:
+                logging.info(f"Completed downloading.")
+                return
+
+            # create directories once here rather than in every worker.
+            parents = {os.path.dirname(f) for (_, buffer_filename, local_filename, _) in new_files for f in (buffer_filename, local_filename) if f is not None}
+            for parent in parents:
+                os.makedirs(parent, exist_ok=True)
+
+            if not sequential:
+                # metadata of downloaded files are inserted in batches rather than one transaction per file.
+                inserter = _BatchInserter(table='file', conns=conns)
+                # errors in workers are logged as soon as each job finishes rather than after all workers have completed.
+                # only a few jobs per worker are queued at a time; the rest are submitted as jobs finish.
+                args_iter = (
+                    dict(
+                        source_filename=source_filename, buffer_filename=buffer_filename, local_filename=local_filename, database_filename=database_filename,
+                        credentials=credentials, callback=self.callback, inserter=inserter
                     )
-                        for (source_filename, buffer_filename, local_filename, database_filename) in \
-                            zip(source_filenames, buffer_filenames, local_filenames, database_filenames)
-                ]
-            # make sure no error happened during download
-            for future, source_filename in zip(futures, source_filenames):
-                try:
-                    result = future.result()# this raises Error in case of Error in a worker
-                except Exception as e:
-                    # Do not raise Error because that would be inconvenient for live download.
-                    logging.error(f"Error occurred while processing {source_filename}.\n{get_exception_text(e)}")
-        else:
-            raise NotImplementedError("this part probably needs to be checked.")
-            for source_filename, local_filename, database_filename in zip(source_filenames, local_filenames, database_filenames):
-                download_process_insert(
-                    source_filename=source_filename, local_filename=local_filename,
-                    database_filename=database_filename, proc_fn=self.process_and_validate_individual_file, credentials=credentials
+                        for (source_filename, buffer_filename, local_filename, database_filename) in new_files
                 )
-                logging.info(f"Successfully saved a file locally: {local_filename}")
+                try:
+                    with ThreadPoolExecutor(max_workers=self.max_workers) as exe:
+                        futures = {exe.submit(download_process_insert, args): args['source_filename'] for args in islice(args_iter, 2 * self.max_workers)}
+                        while futures:
+                            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                source_filename = futures.pop(future)
+                                # make sure no error happened during download
+                                try:
+                                    future.result()# this raises Error in case of Error in a worker
+                                except Exception as e:
+                                    # Do not raise Error because that would be inconvenient for live download.
+                                    logging.error(f"Error occurred while processing {source_filename}.\n{get_exception_text(e)}")
+                                # refill the queue.
+                                for args in islice(args_iter, 1):
+                                    futures[exe.submit(download_process_insert, args)] = args['source_filename']
+                finally:
+                    # insert whatever is left in the buffer, even if interrupted, so that downloaded files are registered.
+                    inserter.flush()
+            else:
+                raise NotImplementedError("this part probably needs to be checked.")
+                for source_filename, _, local_filename, database_filename in new_files:
+                    download_process_insert(
+                        source_filename=source_filename, local_filename=local_filename,
+                        database_filename=database_filename, proc_fn=self.process_and_validate_individual_file, credentials=credentials
+                    )
+                    logging.info(f"Successfully saved a file locally: {local_filename}")
 
-        logging.info(f"Completed downloading.")
+            logging.info(f"Completed downloading.")
+        finally:
+            # database connections are reused throughout the download, so close them only at the end.
+            conns.close()
     
     @param_constraints(start=pd.Timestamp, end=pd.Timestamp)
     def calculate_filenames_for_range(self, *, start, end, **kwargs):
         def convert_paths(paths, varname, relative_to):
+            # string operations only; constructing a Path per filename is slow for thousands of files.
+            # both sides are normalized, as base_dir may end with '/' and thus data_dir contain '//'.
+            prefix = os.path.join(os.path.normpath(str(relative_to)), '') # with trailing separator
             ret = []
             for p in paths:
                 if p is None:
                     ret.append(None)
-                elif Path(p).is_absolute():
-                    if not Path(p).relative_to(relative_to):
+                elif os.path.isabs(p):
+                    if not os.path.normpath(p).startswith(prefix):
                         raise ValueError(f"Expected all elements in '{varname}' under {relative_to}, got {p} instead.")
                     ret.append(p)
                 else:
@@ -210,6 +277,120 @@ class DownloadManager():
             raise FileNotFoundError(f"Expected directory at {self.database_dir}, found nothing. Perhaps this object has never downloaded anything?")
         return [str(Path(f"{self.database_dir}{f}")) for f in os.listdir(self.database_dir)]
 
+# Per connection pragmas must be set every time a connection is opened (see _ConnectionCache.get()).
+# journal_mode=WAL is not among them: it is stored in the database file and only set when opted in (see _enable_wal()).
+_SQLITE_CONNECTION_PRAGMAS = (
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",   # 256 MiB
+)
+
+class _ConnectionCache():
+    """SQLite connections opened once per (thread, db_filename) and reused until close() is called.
+    One object is created per DownloadManager.download_files() call, so that closing it never affects other calls.
+    sqlite3 connections must not be used by multiple threads at once, hence thread-local.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._conns = [] # every connection of every thread, so that they can be closed from the calling thread.
+        self._lock = threading.Lock()
+
+    def get(self, db_filename):
+        """Returns the calling thread's connection to db_filename with _SQLITE_CONNECTION_PRAGMAS applied, opening it if needed."""
+        conns = self._local.__dict__.setdefault('conns', {})
+        if db_filename not in conns:
+            # check_same_thread=False only so that close() can close it. It is never shared otherwise.
+            conn = sqlite3.connect(db_filename, check_same_thread=False)
+            for pragma in _SQLITE_CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            if conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+                # with WAL, fsync at checkpoints only instead of every commit. Not safe with the rollback journal.
+                conn.execute("PRAGMA synchronous=NORMAL")
+            conns[db_filename] = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conns[db_filename]
+
+    def close(self):
+        """Closes all connections. Must be called once no other thread is using them."""
+        with self._lock:
+            while self._conns:
+                self._conns.pop().close()
+        self._local = threading.local()
+
+
+def _enable_wal(db_filename, conns):
+    """Switches db_filename to WAL mode so that readers do not block the writer and vice versa.
+    Persistent. Do not use for databases on network filesystems or shared among hosts, which WAL does not support.
+    """
+    conn = conns.get(db_filename)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+def lookup_existing_batch(db_filename, source_filenames, conns, batch_size=500):
+    """Returns the subset of source_filenames that are already registered in table 'file' of db_filename.
+    Queries are issued in batches of batch_size to stay below SQLite's limit on the number of bound parameters.
+    """
+    existing = set()
+    conn = conns.get(db_filename)
+    for i in range(0, len(source_filenames), batch_size):
+        batch = source_filenames[i:i + batch_size]
+        placeholders = ','.join('?' * len(batch))
+        rows = conn.execute(f"SELECT source_filename FROM file WHERE source_filename IN ({placeholders})", batch)
+        existing.update(row[0] for row in rows)
+    return existing
+
+class _BatchInserter():
+    """Buffers rows per database file and inserts them with one transaction per batch.
+    Thread-safe, so that a single object can be shared among the workers of ThreadPoolExecutor.
+    Rows already in the table (same primary key) are ignored.
+    Rows stay in the buffer until they are committed, so a failed insert is retried by the next flush.
+    """
+    def __init__(self, table, conns, batch_size=100):
+        self.table = table
+        self.conns = conns # _ConnectionCache
+        self.batch_size = batch_size
+        self._rows = defaultdict(deque) # db_filename -> rows (dict) waiting to be inserted
+        self._lock = threading.Lock()
+
+    def add(self, db_filename, row: dict):
+        with self._lock:
+            self._rows[db_filename].append(row)
+            if len(self._rows[db_filename]) >= self.batch_size:
+                try:
+                    self._flush(db_filename)
+                except Exception as e:
+                    # Do not raise; the batch holds rows of other files, not only this one. Retried by the next flush.
+                    logging.warning(f"Failed to insert {len(self._rows[db_filename])} rows into {db_filename}. Retry later.\n{get_exception_text(e)}")
+
+    def flush(self):
+        """Inserts all buffered rows. Never raises; each database is flushed independently and failures are logged."""
+        with self._lock:
+            for db_filename in list(self._rows):
+                try:
+                    self._flush(db_filename)
+                except Exception as e:
+                    source_filenames = [row['source_filename'] for row in self._rows[db_filename]]
+                    logging.error(f"Failed to register the following files in {db_filename}:\n\t{source_filenames}\n{get_exception_text(e)}")
+
+    def _flush(self, db_filename):
+        # caller must hold self._lock
+        rows = self._rows[db_filename]
+        if len(rows) > 0:
+            columns = list(rows[0].keys())
+            query = f"INSERT OR IGNORE INTO {self.table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            conn = self.conns.get(db_filename)
+            with conn:# commits at once, or rolls back on error.
+                conn.executemany(query, [[_to_sql_value(row[c]) for c in columns] for row in rows])
+        # only drop the rows once they are committed.
+        del self._rows[db_filename]
+
+
+def _to_sql_value(value):
+    # sqlite3 only adapts exact datetime type, not subclasses such as pd.Timestamp.
+    if isinstance(value, datetime):
+        return str(value)
+    return value
+
 # def download_process_insert(source_filename, local_filename, database_filename, callback, credentials):
 def download_process_insert(args): # args = dict(source_filename, local_filename, database_filename, callback, credentials)
     source_filename   = args['source_filename']
@@ -218,15 +399,14 @@ def download_process_insert(args): # args = dict(source_filename, local_filename
     database_filename = args['database_filename']
     callback          = args['callback']
     credentials       = args['credentials']
-
-    Path(buffer_filename).parent.mkdir(exist_ok=True, parents=True)
+    inserter          = args['inserter']
 
     # download file
     flag = safe_download_file(source_filename, buffer_filename, credentials=credentials, max_trial=5, http_404_ok=True, exist_ok=False)
     if flag:
         # callback and safe_insert should only happen when files are downloaded successfully.
         file_metadata = callback(source_filename, buffer_filename, local_filename)
-        sql.safe_insert(db_filename=database_filename, table='file', data=file_metadata.to_dict())
+        inserter.add(database_filename, file_metadata.to_dict())
 
 
 def safe_download_file(source_filename, dest_filename, credentials=None, max_trial=5, http_404_ok=True, exist_ok=False):
@@ -263,11 +443,10 @@ def safe_download_file(source_filename, dest_filename, credentials=None, max_tri
                     raise FileNotFoundError(f"{source_filename} does not exist.") #If 404, no point in trying again. Simply raise Exception.
             
             # Check for maximum trial
-            if trial < max_trial:
+            if trial < max_trial - 1:
                 logging.warning(f"The following Exception occured at trial {trial + 1}/{max_trial}\n\twhile processing {source_filename}. Retry.")
                 logging.warning(f"{get_exception_text(e)}.")
-                # sleep for 5 seconds.
-                time.sleep(5)
+                time.sleep(_retry_delay(e, trial))
                 continue
             else:
                 logging.critical(f"Maximum trial reached. The following Exception occured at {trial +1}/{max_trial}\n\twhile processing {source_filename}. Terminating.")
@@ -275,10 +454,27 @@ def safe_download_file(source_filename, dest_filename, credentials=None, max_tri
                 raise MaximumTrialExceededError(f"Extraction failed at the last attemt. Terminating.")
 
 
+def _retry_delay(e, trial):
+    """Returns seconds to wait before retrying after Exception e occurred at (0-indexed) trial.
+    Exponential backoff with jitter, so that workers failing at the same time do not retry in sync.
+        - IncompleteDownloadError: no wait. Usually means the remote file changed during download (live data).
+        - Connection reset / timeout: backoff with 1 second base.
+        - Anything else (e.g. HTTP 429, 5xx): backoff with 2 seconds base.
+    """
+    if isinstance(e, IncompleteDownloadError):
+        return 0
+    if isinstance(e, (ConnectionError, TimeoutError, urllib3.exceptions.HTTPError)) \
+            or (isinstance(e, URLError) and not isinstance(e, HTTPError)):
+        base = 1.0
+    else:
+        base = 2.0
+    return min(30.0, base * (2 ** trial) * random.uniform(0.5, 1.5))
+
+
 def download_file(source_filename, dest_filename, credentials=None):
     """Makes an attempt to download a file at souce_filename and save locally as dest_filename.
     Pass credentials="username:pass" in case authentication is needed.
-    Compares the bytesize on remote and local, and raises IncompleteDownloadError() if mismatch is detented.
+    Compares the bytesize on remote and the bytes written locally, and raises IncompleteDownloadError() if mismatch is detented.
     Returns True if successful (for backward compatibility.)
 
     Here are some helpful links.
@@ -291,29 +487,129 @@ def download_file(source_filename, dest_filename, credentials=None):
     """
     if credentials is not None:
         # in case credentials are given, a little work is needed...
-        # set up HTTP request with credential header and get bitesize.
-        encoded_credentials = base64.b64encode(credentials.encode('ascii'))
+        # set up HTTP request with credential header.
         req = urllib.request.Request(source_filename)
-        req.add_header(
-            "Authorization", f'Basic {encoded_credentials.decode("ascii")}'
-        )
+        req.add_header("Authorization", _basic_auth_header(credentials))
         cj = CookieJar() # Cookie setting needed in case of HTTP302 redirect error.
         opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj))
-        # Get the bytesize of the file to be downloaded.
-        with opener.open(req) as r:
-            bytesize = int(r.info()['Content-Length'])
 
         # if credentials are given, use request package to download.
         with opener.open(req) as response, open(dest_filename, 'wb') as f_save:
-            data = response.read()
-            f_save.write(data)
+            # Get the bytesize of the file to be downloaded from the same response.
+            bytesize = int(response.headers['Content-Length'])
+            # copy in 1 MiB chunks rather than holding the whole file in memory.
+            shutil.copyfileobj(response, f_save, length=1 << 20)
+            bytes_written = f_save.tell()
     else:
-        # Get the bytesize of the file to be downloaded.
-        bytesize = int(urlopen(source_filename).info()['Content-Length'])
-        # download.
-        urlretrieve(source_filename, dest_filename)
+        # GET through the shared pool, asking for the first part only. A small file arrives whole with this single request.
+        # For a large file, this response is streamed as the first part while the rest is downloaded in parallel.
+        response = _POOL.request('GET', source_filename, headers={'Range': f'bytes=0-{_MULTIPART_PART_SIZE - 1}'}, preload_content=False)
+        if response.status == 416:
+            # range not satisfiable, i.e., empty file. Plain GET instead.
+            response.drain_conn()
+            response = _POOL.request('GET', source_filename, preload_content=False)
+        if response.status >= 400:
+            response.drain_conn() # error bodies are small. Keeps the connection reusable.
+            # raise the same exception as urlopen() would so that safe_download_file() can handle it.
+            raise HTTPError(source_filename, response.status, response.reason, response.headers, None)
+        try:
+            if response.status == 206:
+                # bytesize is read off Content-Range, e.g., "bytes 0-67108863/512000000"
+                bytesize = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                bytes_written = download_file_multipart(source_filename, dest_filename, bytesize, first_response=response)
+            else:
+                # the server ignored the range request and sent the whole file. bytesize is read off the same response.
+                bytesize = int(response.headers['Content-Length'])
+                with open(dest_filename, 'wb') as f_save:
+                    for chunk in response.stream(1 << 20):
+                        f_save.write(chunk)
+                    bytes_written = f_save.tell()
+        except BaseException:
+            response.close() # never hand a half-read connection back to the pool.
+            raise
+        finally:
+            response.release_conn()
     
-    if os.stat(dest_filename).st_size != bytesize:
+    # compare against what was written rather than os.stat(), which is a metadata request on network filesystems (e.g., Lustre).
+    if bytes_written != bytesize:
         raise IncompleteDownloadError(f"Incomplete download for {source_filename}.")
 
-    return True # for backward compatibility
\ No newline at end of file
+    return True # for backward compatibility
+
+
+def download_file_multipart(source_filename, dest_filename, bytesize, first_response):
+    """Downloads source_filename of bytesize bytes as byte ranges of _MULTIPART_PART_SIZE, up to _MULTIPART_N_PARTS at a time.
+    first_response is the (HTTP 206) response to the request for the first range. It is streamed by the calling thread
+    while the other ranges are downloaded in parallel through the shared pool.
+    Each range is written at its own offset of dest_filename (os.pwrite), so no locking is needed.
+    The other ranges are requested with If-Match (or If-Unmodified-Since) so that all ranges come from the same version of the file.
+    Returns the number of bytes written.
+    """
+    preconditions = _precondition_headers(first_response.headers)
+    ranges = [(start, min(start + _MULTIPART_PART_SIZE, bytesize) - 1) for start in range(_MULTIPART_PART_SIZE, bytesize, _MULTIPART_PART_SIZE)]
+    fd = os.open(dest_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.ftruncate(fd, bytesize)
+        if len(ranges) == 0:# small file. first_response has all of it.
+            return _write_stream_at(fd, first_response, 0)
+        with ThreadPoolExecutor(max_workers=_MULTIPART_N_PARTS - 1) as exe:
+            futures = [exe.submit(_download_range, source_filename, fd, start, end, preconditions) for (start, end) in ranges]
+            try:
+                bytes_written = _write_stream_at(fd, first_response, 0)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return bytes_written + sum(future.result() for future in futures)
+    finally:
+        os.close(fd)
+
+
+def _precondition_headers(headers):
+    """Returns headers that make a range request fail with HTTP 412 if the file differs from the one that returned headers."""
+    etag = headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):# weak ETags never match If-Match.
+        return {'If-Match': etag}
+    last_modified = headers.get('Last-Modified')
+    if last_modified is not None:
+        return {'If-Unmodified-Since': last_modified}
+    return {}
+
+
+def _download_range(source_filename, fd, start, end, preconditions):
+    """Downloads bytes start-end (inclusive) of source_filename into file descriptor fd at the same offset.
+    Returns the number of bytes written.
+    """
+    response = _POOL.request('GET', source_filename, headers={'Range': f'bytes={start}-{end}', **preconditions}, preload_content=False)
+    try:
+        if response.status == 412:
+            raise IncompleteDownloadError(f"{source_filename} changed during download.")
+        if response.status >= 400:
+            raise HTTPError(source_filename, response.status, response.reason, response.headers, None)
+        if response.status != 206:
+            raise IncompleteDownloadError(f"Range request for {source_filename} was not honored (HTTP {response.status}).")
+        return _write_stream_at(fd, response, start)
+    except BaseException:
+        response.close() # never hand a half-read connection back to the pool.
+        raise
+    finally:
+        response.release_conn()
+
+
+def _write_stream_at(fd, response, offset):
+    """Writes the body of response into file descriptor fd starting at offset. Returns the number of bytes written."""
+    start = offset
+    for chunk in response.stream(1 << 20):
+        view = memoryview(chunk)
+        while view:# os.pwrite may write less than requested.
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+    return offset - start
+
+
+@lru_cache(maxsize=None)
+def _basic_auth_header(credentials):
+    """Returns the value of 'Authorization' header for credentials="username:pass"."""
+    encoded_credentials = base64.b64encode(credentials.encode('ascii'))
+    return f'Basic {encoded_credentials.decode("ascii")}'
\ No newline at end of file
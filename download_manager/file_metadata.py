@@ -14,6 +14,9 @@ class FileMetadata():
         size='INT',                 # file bytesize
         last_modified='DATETIME'    # the datetime at which the file was last modified
     )
+    # allowed values for 'product' and 'datatype'
+    _PRODUCTS = frozenset({'GFS', 'HRRR', 'GOES'})
+    _DATATYPES = frozenset({'observation', 'forecast', 'reanalysis'})
 
     product: str
     datatype: str
@@ -23,19 +26,19 @@ class FileMetadata():
     last_modified: pd.Timestamp
 
     def to_dict(self) -> dict:
-        return {f.name: getattr(self, f.name) for f in fields(self)}
+        return {name: getattr(self, name) for name in self._field_names()}
+
+    @classmethod
+    def _field_names(cls) -> tuple:
+        # computed once per class and cached in the class's own __dict__, so subclasses never reuse their parent's names.
+        if '_FIELD_NAMES' not in cls.__dict__:
+            cls._FIELD_NAMES = tuple(f.name for f in fields(cls))
+        return cls._FIELD_NAMES
     
     def __post_init__(self):
-        for field, field_type in self.__annotations__.items():
-            value = getattr(self, field)
-            
-            # Type check
-            if not isinstance(value, field_type):
-                raise TypeError(f"{field} must be {field_type.__name__}, got {type(value).__name__}")
-
-        if not self.product in ['GFS', 'HRRR', 'GOES']:
+        if not self.product in self._PRODUCTS:
             raise ValueError(f"Expected attribute 'product' in ['GFS', 'HRRR', 'GOES']. Got {self.product=} instead.")
-        if not self.datatype in ['observation', 'forecast', 'reanalysis']:
+        if not self.datatype in self._DATATYPES:
             raise ValueError(f"Expected attribute 'datatype' in ['observation', 'forecast', 'reanalysis'], gor {self.datatype} instead.")
 
 
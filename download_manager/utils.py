@@ -1,4 +1,4 @@
-from itertools import product
+import math
 import numpy as np
 
 class ArrayParser():
@@ -10,15 +10,22 @@ class ArrayParser():
         p(-1) = {'year': 1979, 'region': 'big_island'}
     """
     def __init__(self, **kwargs):
-        self.products = list(product(*[v for k, v in kwargs.items()]))
+        # i-th combination is computed on demand from strides rather than materializing the cartesian product.
         self.keys = list(kwargs.keys())
-        self._Ns = [len(v) for k, v in kwargs.items()]
+        self._values = [list(v) for v in kwargs.values()]
+        self._Ns = [len(v) for v in self._values]
+        self._strides = [math.prod(self._Ns[d + 1:]) for d in range(len(self._Ns))]
+        self._len = math.prod(self._Ns)
 
     def unpack(self, i):
-        return {k: v for k, v in zip(self.keys, self.products[i])}
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(f"index out of range for {self}")
+        return {k: v[(i // stride) % n] for k, v, stride, n in zip(self.keys, self._values, self._strides, self._Ns)}
 
     def __len__(self):
-        return np.prod(self._Ns)
+        return self._len
     
     def __call__(self, i):
         """
@@ -45,10 +52,11 @@ class ArrayParser():
         ```
         """
         if isinstance(i, slice):
-            start = i.start if i.start is not None else 0
-            stop = i.stop if i.stop is not None else len(self)
-            step = i.step if i.step is not None else 1
-            return [self.unpack(i) for i in range(start, stop, step)]
+            # decompose all indices at once rather than calling self.unpack() per index.
+            indices = np.arange(*i.indices(len(self)))
+            coords = np.unravel_index(indices, self._Ns)
+            columns = [[v[j] for j in c.tolist()] for v, c in zip(self._values, coords)]
+            return [dict(zip(self.keys, row)) for row in zip(*columns)]
         else:
             return self.unpack(i)
     
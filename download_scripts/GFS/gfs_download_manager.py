@@ -1,9 +1,13 @@
 from download_manager import DownloadManager, GFSForecastMetadata
 import pandas as pd
+import numpy as np
 from pathlib import Path
-import os, re
+import os, re, subprocess, shlex, tempfile, logging
 from datetime import datetime
-from nimbus.common.io import run_command
+
+# date, issue hour and forecast horizon in source_filename, e.g., "gfs.20220626/00/atmos/gfs.t00z.pgrb2.0p25.f024"
+#   . followed by 8 digits, two digits surrounded by two /'s, and .f followed by 3 digits
+_SOURCE_FILENAME_PATTERN = re.compile(r'\.(\d{8})/(\d{2})/.*\.f(\d{3})')
 
 class GFSForecastDownloadManager(DownloadManager):
     def __init__(
@@ -15,8 +19,10 @@ class GFSForecastDownloadManager(DownloadManager):
             variables,
             region_bound,
             log_filename,
+            max_workers=None,
+            sqlite_wal=False,
         ):
-        super().__init__(base_dir=base_dir, buffer_dir=buffer_dir, db_field_dtypes=GFSForecastMetadata.dtypes, log_filename=log_filename)
+        super().__init__(base_dir=base_dir, buffer_dir=buffer_dir, db_field_dtypes=GFSForecastMetadata.dtypes, log_filename=log_filename, max_workers=max_workers, sqlite_wal=sqlite_wal)
         self.variables = variables
         self.region_bound = region_bound
         self.forecast_horizon_hours = forecast_horizon_hours
@@ -26,24 +32,35 @@ class GFSForecastDownloadManager(DownloadManager):
         def parse_source_filename(url):
             # E.g. "https://noaa-gfs-bdp-pds.s3.amazonaws.com/gfs.20220626/00/atmos/gfs.t00z.pgrb2.0p25.f024"
             
-            d = re.search(r'\.(\d{8})/', url).group(1)    # look for . followed by 8 digits
-            h = re.search(r'/(\d{2})/', url).group(1)     # look for two digits surrounded by two /'s
-            f = int(re.search(r'\.f(\d{3})', url).group(1)) # look for . followed by 3 digits
+            d, h, f = _SOURCE_FILENAME_PATTERN.search(url).groups()
             t0 = datetime.strptime(d + h, "%Y%m%d%H")
-            return t0, f
+            return t0, int(f)
 
-        temp_filename = f"{buffer_filename}.partial.grib2"
         # filter_key = f":({'|'.join(PRESSURE_VARIABLE_KEYS)}):({'|'.join(map(str, PLEVELS))}) mb:|" + '|'.join(SURFACE_VARIABLES)
         filter_key = '|'.join(self.variables)
-        Path(local_filename).parent.mkdir(parents=True, exist_ok=True)
-        compress_command = f"wgrib2 {buffer_filename} -match '{filter_key}' -small_grib {self.region_bound} {temp_filename}"
-        conversion_command = f"wgrib2 {temp_filename} -netcdf {local_filename}"
+        # compress and convert in one pipeline; the cropped grib2 goes through a pipe instead of a temporary file.
+        # -inv /dev/null keeps the inventory out of the grib2 stream written to stdout.
+        # local_filename's parent directory is created upfront by DownloadManager.download_files().
+        compress_command = ['wgrib2', buffer_filename, '-inv', '/dev/null', '-match', filter_key, '-small_grib', *self.region_bound.split(), '-']
+        conversion_command = ['wgrib2', '-', '-netcdf', local_filename]
 
-        run_command(compress_command)
-        run_command(conversion_command)
+        logging.info(f"{shlex.join(compress_command)} | {shlex.join(conversion_command)}")
+        # stderr goes to temporary files rather than pipes, which could fill up and block wgrib2 while we wait.
+        with tempfile.TemporaryFile() as compress_stderr, tempfile.TemporaryFile() as conversion_stderr:
+            compress = subprocess.Popen(compress_command, stdout=subprocess.PIPE, stderr=compress_stderr)
+            conversion = subprocess.Popen(conversion_command, stdin=compress.stdout, stdout=subprocess.DEVNULL, stderr=conversion_stderr)
+            compress.stdout.close() # so that compress gets SIGPIPE if conversion exits early.
+            conversion.wait()
+            compress.wait()
+            # check conversion first: if it fails, compress typically dies of SIGPIPE, which is not the cause.
+            for proc, stderr in ((conversion, conversion_stderr), (compress, compress_stderr)):
+                if proc.returncode != 0:
+                    stderr.seek(0)
+                    message = stderr.read().decode(errors='replace')
+                    logging.error(f"{shlex.join(proc.args)} exited with {proc.returncode}.\n{message}")
+                    raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=message)
 
         Path(buffer_filename).unlink()
-        Path(temp_filename).unlink()
 
         utc_issue_timestamp, forecast_horizon = parse_source_filename(source_filename)
         return GFSForecastMetadata(
@@ -62,19 +79,27 @@ class GFSForecastDownloadManager(DownloadManager):
             & (utc_issue_timestamps >= start)
             & (utc_issue_timestamps <= end)]
 
-        source_filenames, buffer_filenames, local_filenames, db_filenames = [], [], [], []
-        for utc_issue_timestamp in utc_issue_timestamps:
-            for forecast_horizon_hour in self.forecast_horizon_hours:
-                str_format = utc_issue_timestamp.strftime(f"gfs.%Y%m%d/%H/atmos/gfs.t%Hz.pgrb2.0p25.f{forecast_horizon_hour:03d}")
-                source_filenames.append(f"https://noaa-gfs-bdp-pds.s3.amazonaws.com/{str_format}")
-                buffer_filenames.append(str_format)
-                local_filenames.append(utc_issue_timestamp.strftime(f"%Y_%m/%d/%Y_%m_%d_%H:00_f{forecast_horizon_hour:03d}.nc"))
-                db_filenames.append(utc_issue_timestamp.strftime("%Y_%m.db"))
+        # every combination of issue timestamp (outer) and forecast horizon (inner), built with array operations.
+        # strftime is only called once per issue timestamp, then repeated for each forecast horizon.
+        n_horizons = len(self.forecast_horizon_hours)
+        def repeat_strftime(fmt):
+            return np.repeat(np.asarray(utc_issue_timestamps.strftime(fmt), dtype=str), n_horizons)
+        fh = np.tile(np.asarray([f"{h:03d}" for h in self.forecast_horizon_hours], dtype=str), len(utc_issue_timestamps))
+
+        buffer_filenames = np.char.add(repeat_strftime("gfs.%Y%m%d/%H/atmos/gfs.t%Hz.pgrb2.0p25.f"), fh)
+        source_filenames = np.char.add("https://noaa-gfs-bdp-pds.s3.amazonaws.com/", buffer_filenames)
+        local_filenames = np.char.add(np.char.add(repeat_strftime("%Y_%m/%d/%Y_%m_%d_%H:00_f"), fh), ".nc")
+        db_filenames = repeat_strftime("%Y_%m.db")
 
-        return source_filenames, buffer_filenames, local_filenames, db_filenames
+        return source_filenames.tolist(), buffer_filenames.tolist(), local_filenames.tolist(), db_filenames.tolist()
 
     def cleanup(self):
-        root = Path(self.buffer_dir)
-        for path in sorted(root.rglob('*'), key=lambda p: len(p.parts), reverse=True): # deepest directories first
-            if path.is_dir() and not any(path.iterdir()): # remove if empty (Path.rmdir() cannot remove non-empty dir anyways, so it is safe.)
-                path.rmdir()
\ No newline at end of file
+        # topdown=False visits the deepest directories first, so that parents emptied by removing their children are removed too.
+        removed = set()
+        for dirpath, dirnames, filenames in os.walk(self.buffer_dir, topdown=False):
+            if dirpath == self.buffer_dir:
+                continue # keep buffer_dir itself.
+            # dirnames is listed before its children are visited, so check against what has been removed since.
+            if not filenames and all(os.path.join(dirpath, d) in removed for d in dirnames):
+                os.rmdir(dirpath)
+                removed.add(dirpath)
\ No newline at end of file